@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.api.api import (
+    mount_endpoint,
+    define_headers,
+    get_site_info,
+    post_results,
+)
+from src.utils.api.limiter import AdaptiveLimiter
+
+"""
+Benchmarks the HTTP/1.1 & HTTP/2 transports against a local, h2c-capable stand-in for the API
+
+The stand-in is served by hypercorn, which speaks both HTTP/1.1 & HTTP/2 over cleartext on the same port
+Every request records the client (host, port) it arrived on, so the number of distinct clients is the number of connections
+(i.e. handshakes) each transport needed
+
+Requires the optional "bench" dependencies - pip install ".[bench]" - & is run from the project root:
+
+    python3 -m benchmarks.bench_transport --requests 1000 --concurrency 32
+"""
+
+# Distinct (host, port) pairs seen by the stand-in server - one per connection opened by the client
+connections = set()
+
+
+def _load_event(path: str):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+SITE_INFO_BODY = _load_event("./tests/events/site-info/valid_site_info.json")
+
+
+def _stand_in_app(server_latency: float):
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        connections.add(tuple(scope["client"]))
+
+        # Drain the request body, POSTs send us their results
+        more_body = True
+        while more_body:
+            message = await receive()
+            more_body = message.get("more_body", False)
+
+        # Simulate the API doing some work, so that requests genuinely overlap
+        await asyncio.sleep(server_latency)
+
+        body = SITE_INFO_BODY if scope["method"] == "GET" else b"{}"
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def _start_stand_in_server(port: int, server_latency: float):
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.accesslog = None
+    started, controls = threading.Event(), {}
+
+    def _run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        shutdown = asyncio.Event()
+        controls["stop"] = lambda: loop.call_soon_threadsafe(shutdown.set)
+        started.set()
+        loop.run_until_complete(
+            serve(_stand_in_app(server_latency), config, shutdown_trigger=shutdown.wait)
+        )
+
+    server = threading.Thread(target=_run, name="stand-in-server", daemon=True)
+    server.start()
+    started.wait()
+    # Give hypercorn a moment to bind before we start sending requests
+    time.sleep(0.5)
+    return server, controls["stop"]
+
+
+def _run_transport(transport: str, api_url: str, requests: int, concurrency: int):
+    # Pin the limiter to our target concurrency - we are measuring the transport here, not the limiter
+    limiter = AdaptiveLimiter(
+        initial_limit=concurrency,
+        min_limit=concurrency,
+        max_limit=concurrency,
+        rate=1e6,
+    )
+    session = mount_endpoint(transport=transport, limiter=limiter)
+    if transport == "http1":
+        # Our stand-in server is cleartext, so re-use our sized https:// adapter for http:// too
+        session.mount("http://", session.get_adapter("https://"))
+    headers = define_headers(api_key="benchmark")
+
+    # Returns the request's latency, or None if it failed - one failure shouldn't abort the whole run
+    def _call(index: int):
+        start = time.perf_counter()
+        try:
+            # Alternate between GET & POST, as the application does
+            if index % 2:
+                response = get_site_info(
+                    api_endpoint_url=api_url, headers=headers, requests_session=session
+                )
+            else:
+                response = post_results(
+                    api_endpoint_url=api_url,
+                    headers=headers,
+                    requests_session=session,
+                    data=[],
+                )
+        except Exception:
+            return None
+        if response.status_code != 200:
+            return None
+        return time.perf_counter() - start
+
+    connections.clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_call, range(requests)))
+    elapsed = time.perf_counter() - start
+    session.close()
+
+    latencies = sorted(latency for latency in results if latency is not None)
+    return {
+        "transport": transport,
+        "requests": requests,
+        "failures": requests - len(latencies),
+        "connections": len(connections),
+        "p50_ms": (
+            round(statistics.median(latencies) * 1000, 2) if latencies else None
+        ),
+        "p99_ms": (
+            round(latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000, 2)
+            if latencies
+            else None
+        ),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the HTTP/1.1 & HTTP/2 API transports."
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--server-latency-ms", type=float, default=20.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--transports", nargs="+", default=["http1", "h2c"])
+    args = parser.parse_args()
+
+    # Per-request logging would dominate our timings
+    logging.disable(logging.INFO)
+
+    server, stop = _start_stand_in_server(
+        port=args.port, server_latency=args.server_latency_ms / 1000
+    )
+    try:
+        for transport in args.transports:
+            print(
+                json.dumps(
+                    _run_transport(
+                        transport=transport,
+                        api_url=f"http://127.0.0.1:{args.port}",
+                        requests=args.requests,
+                        concurrency=args.concurrency,
+                    )
+                )
+            )
+    finally:
+        stop()
+        server.join(timeout=5)
+
+
+if __name__ == "__main__":
+    main()
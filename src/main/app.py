@@ -1,6 +1,9 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from sys import stdout
-from src.utils.config.initialise_config import init_config
+from tempfile import TemporaryDirectory
+from src.utils.config.initialise_config import init_config, load_settings
+from src.utils.config.initialise_logging import init_logging
 from src.utils.api.api import (
     mount_endpoint,
     define_headers,
@@ -8,11 +11,19 @@ from src.utils.api.api import (
     get_site_info,
     post_results,
 )
+from src.utils.api.limiter import AdaptiveLimiter
 from src.utils.transformation.filter_outages import (
     filter_outages_by_datetime,
     filter_outages_by_site_info,
 )
 from src.utils.transformation.generate_result import produce_final_output
+from src.utils.transformation.parallel_transform import produce_final_outputs_parallel
+from src.utils.transformation.external_sort import (
+    iter_json_array,
+    spill_sorted_runs,
+    produce_final_output_from_runs,
+)
+from src.utils.pipeline.stage_executor import Stage, StageExecutor
 
 """
 To enable other people to run this application, adding environment functionality for config initialisation
@@ -20,11 +31,14 @@ In a normal working env. everyone should have access to the same AWS account for
 Using env. variables will also allow for easier unit/integration test validation from their local machine
 """
 
-# You can "print" logs to the console using stdout
-logging.basicConfig(stream=stdout, level=logging.INFO)
+# You can "print" logs to the console using stdout - written on a background thread, so logging never blocks the application
+init_logging(level=logging.INFO, stream=stdout)
 # Instantiate logger for app.py using the "__name__" variable
 logger = logging.getLogger(__name__)
 
+# Application configuration - tuning knobs live in per-environment profiles, selected with KRAKEN_APP_PROFILE
+CONFIG_PATH = "./config.yaml"
+
 
 def main():
     """
@@ -42,51 +56,169 @@ def main():
             * This could be prevented by setting secrets as env. variables using "os" library - but wanted to demonstrate best practices where possible
     """
 
+    # Load the settings for our profile - site-ids, concurrency, transformation mode etc.
+    settings = load_settings(config_path=CONFIG_PATH)
 
-    # SSM flag - set to true if user wants to retrieve secrets from SSM, otherwise use env. variables - see README.md
-    ssm_flag = False
-
-    # Initialise config
-    API_URL, API_KEY = init_config(config_path="./config.yaml", ssm_flag=ssm_flag)
-
-    # Initialise our requests session & re-try strategy (for potential 5xx errors) - can be re-used in API calls
-    req_session = mount_endpoint()
-
-    # Initialise authorisation headers - can be re-used in API calls
-    headers = define_headers(api_key=API_KEY)
-
-    # Get outages data - this returns response object
-    outages_response = get_outages(
-        api_endpoint_url=API_URL, headers=headers, requests_session=req_session
+    # Initialise config - the profile's "ssm" flag is set to true if user wants to retrieve secrets from SSM, otherwise use env. variables - see README.md
+    API_URL, API_KEY = init_config(
+        config_path=CONFIG_PATH, ssm_flag=settings.ssm, profile=settings.profile
     )
 
-    # Get site-info data - this returns response object
-    site_info_response = get_site_info(
-        api_endpoint_url=API_URL, headers=headers, requests_session=req_session
+    # Initialise our requests session, re-try strategy (for potential 5xx errors) & adaptive limiter - can be re-used in API calls
+    req_session = mount_endpoint(
+        limiter=AdaptiveLimiter(
+            initial_limit=settings.concurrency_initial,
+            max_limit=settings.concurrency_max,
+            rate=settings.requests_per_second,
+        ),
+        transport=settings.transport,
     )
 
-    # Convert object responses into data for manipulation
-    outages_data, site_info_data = outages_response.json(), site_info_response.json()
-
-    # Filter for outages that occurred after "2022-01-01T00:00:00.000Z"
-    filtered_outages_dt = filter_outages_by_datetime(outages=outages_data)
+    # Initialise authorisation headers - can be re-used in API calls
+    headers = define_headers(api_key=API_KEY)
 
-    # Filter for outages that only exist in "site_info_data" devices
-    filtered_outages = filter_outages_by_site_info(
-        filtered_outages_dt=filtered_outages_dt, site_info_data=site_info_data
-    )
+    # Clean up the out-of-core spill directory however we leave - including a failed spill
+    spill_dir = None
+    try:
+        if settings.out_of_core:
+            # Out-of-core, the spill directory lives until every site has been merged from it
+            spill_dir = TemporaryDirectory(prefix="outages-")
+
+        # Get & parse the outages data - shared by every site, so it is only loaded once
+        def load_outages():
+            # This returns response object, streamed when we are processing it out-of-core
+            outages_response = get_outages(
+                api_endpoint_url=API_URL,
+                headers=headers,
+                requests_session=req_session,
+                stream=settings.out_of_core,
+            )
+
+            if settings.out_of_core:
+                # Parse the response body one outage at a time & spill sorted runs to disk, never holding the whole feed in memory
+                return spill_sorted_runs(
+                    outages=iter_json_array(
+                        outages_response.iter_content(chunk_size=65536)
+                    ),
+                    run_dir=spill_dir.name,
+                    memory_budget_bytes=settings.spill_memory_budget_bytes,
+                )
+
+            outages_data = outages_response.json()
+            # In parallel mode each shard applies the datetime filter itself
+            if settings.transform_workers > 1:
+                return outages_data
+
+            # In-process we only need to filter by datetime once - after the profile's cutoff, "2022-01-01T00:00:00.000Z" by default
+            return filter_outages_by_datetime(
+                outages=outages_data, cutoff=settings.outages_cutoff
+            )
+
+        # Fetch stage - get site-info data for a site & convert the response into data for manipulation
+        def fetch_site_info(site_id: str):
+            site_info_response = get_site_info(
+                api_endpoint_url=API_URL,
+                headers=headers,
+                requests_session=req_session,
+                site_id=site_id,
+            )
+            return site_id, site_info_response.json()
+
+        # Transform stage - filter & enrich the outages for a site, once the outages data has loaded
+        def transform_site_outages(fetched: tuple):
+            site_id, site_info_data = fetched
+
+            # Out-of-core, filtering & enrichment happen while merging the sorted runs
+            if settings.out_of_core:
+                final_output = produce_final_output_from_runs(
+                    run_paths=outages_future.result(),
+                    site_info_data=site_info_data,
+                    cutoff=settings.outages_cutoff,
+                )
+                return site_id, final_output
+
+            # Filter for outages that only exist in "site_info_data" devices
+            # Copy each outage so that enriching one site's results never touches the shared outages data
+            filtered_outages = [
+                dict(outage)
+                for outage in filter_outages_by_site_info(
+                    filtered_outages_dt=outages_future.result(),
+                    site_info_data=site_info_data,
+                )
+            ]
+
+            # Now we can generate our final output to POST
+            final_output = produce_final_output(
+                filtered_outages=filtered_outages, site_info_data=site_info_data
+            )
+            return site_id, final_output
+
+        # Post stage - post a site's results to the API endpoint, returning a response
+        def post_site_results(transformed: tuple):
+            site_id, final_output = transformed
+            return post_results(
+                api_endpoint_url=API_URL,
+                headers=headers,
+                requests_session=req_session,
+                data=final_output,
+                site_id=site_id,
+            )
+
+        fetch_stage = Stage(
+            name="fetch", func=fetch_site_info, workers=settings.stage_workers
+        )
+        post_stage = Stage(
+            name="post", func=post_site_results, workers=settings.stage_workers
+        )
 
-    # Now we can generate our final output to POST
-    final_output = produce_final_output(
-        filtered_outages=filtered_outages, site_info_data=site_info_data
-    )
+        # Load the outages data in the background, so the site-info requests overlap with the (largest) outages request
+        with ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="outages"
+        ) as outages_loader:
+            outages_future = outages_loader.submit(load_outages)
+
+            if not settings.out_of_core and settings.transform_workers > 1:
+                # Large feeds are sharded across one pool of worker processes, which filters & enriches every site in one pass
+                # The pool needs every site's devices up front, so we fetch them all before transforming & posting
+                site_info_by_site = dict(
+                    StageExecutor(
+                        stages=[fetch_stage], queue_size=settings.stage_queue_size
+                    ).run(settings.site_ids)
+                )
+                final_outputs = produce_final_outputs_parallel(
+                    outages=outages_future.result(),
+                    site_info_by_site=site_info_by_site,
+                    workers=settings.transform_workers,
+                    cutoff=settings.outages_cutoff,
+                )
+                pipeline = StageExecutor(
+                    stages=[post_stage], queue_size=settings.stage_queue_size
+                )
+                responses = pipeline.run(
+                    [(site_id, final_outputs[site_id]) for site_id in settings.site_ids]
+                )
+            else:
+                # Run every site through the pipeline - posting one site overlaps with fetching & transforming the next
+                pipeline = StageExecutor(
+                    stages=[
+                        fetch_stage,
+                        Stage(
+                            name="transform",
+                            func=transform_site_outages,
+                            workers=settings.stage_workers,
+                        ),
+                        post_stage,
+                    ],
+                    queue_size=settings.stage_queue_size,
+                )
+                responses = pipeline.run(settings.site_ids)
+    finally:
+        if spill_dir is not None:
+            spill_dir.cleanup()
 
-    # & we can post our results to the API endpoint, returning a response
-    response = post_results(
-        api_endpoint_url=API_URL,
-        headers=headers,
-        requests_session=req_session,
-        data=final_output,
+    # The run is only successful if every site was accepted - surface the first failure, otherwise the final response
+    response = next(
+        (response for response in responses if not response.ok), responses[-1]
     )
 
     # Return the API response
@@ -99,12 +231,12 @@ if __name__ == "__main__":
     try:
         response = main()
         logger.info(
-            f"Site-info POST request response: Status code = {response.status_code}."
+            "Site-info POST request response: Status code = %s.", response.status_code
         )
     except Exception as ex:
         # Final catch all, if something we have failed to catch has occurred, raise runtime error & exit
         logger.error(
-            f"There has been an issue successfully running the application: {ex}."
+            "There has been an issue successfully running the application: %s.", ex
         )
         raise RuntimeError
     finally:
@@ -1,32 +1,299 @@
 import logging
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
 import requests
 from requests.adapters import Retry, HTTPAdapter
+from src.utils.api.limiter import AdaptiveLimiter, THROTTLE_STATUS_CODES
 
 # Instantiate logger at module level using the "__name__" variable
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 
-# Define a re-try strategy should we receive 5xx errors from the API
+# Define a re-try strategy should we receive 5xx errors from the API - backing off exponentially so we don't cause a retry storm
 def _define_retry_strategy():
-    return Retry(total=5, status_forcelist=[500, 501, 502, 503, 504])
+    return Retry(
+        total=5, status_forcelist=[500, 501, 502, 503, 504], backoff_factor=0.5
+    )
+
+
+# Transports we can mount - "h2c" is HTTP/2 over cleartext with prior knowledge, typically only useful against local stand-in servers
+TRANSPORTS = ("http1", "http2", "h2c")
+
+
+# As urllib3 does, only methods in the retry strategy's "allowed_methods" (idempotent by default) are safe to re-send
+def _is_method_retryable(retry_strategy: Retry, method: str):
+    return (
+        not retry_strategy.allowed_methods
+        or method.upper() in retry_strategy.allowed_methods
+    )
+
+
+# Group requests by endpoint for the limiter's latency baselines, e.g. "GET /site-info/*"
+# The last segment of a nested path is an ID (a site-id here), so every site shares one baseline
+def _endpoint_key(method: str, url: str):
+    path = urlsplit(url).path.rstrip("/")
+    parent = path.rpartition("/")[0]
+    return f"{method.upper()} {parent + '/*' if parent else path or '/'}"
+
+
+# Issue a request through the limiter, retrying retryable status codes - shared by every transport
+# Which responses are retried is left to the retry strategy, so non-idempotent methods (POST) are never re-sent
+# "retryable_errors" are exceptions from "send" that can be retried for idempotent methods, e.g. a dropped connection
+def _send_with_feedback(
+    limiter: AdaptiveLimiter,
+    retry_strategy: Retry,
+    send,
+    method: str,
+    url: str,
+    retryable_errors: tuple = (),
+):
+    attempts = (retry_strategy.total or 0) + 1
+    endpoint = _endpoint_key(method=method, url=url)
+    for attempt in range(attempts):
+        limiter.acquire()
+        try:
+            response = send()
+        except Exception as ex:
+            # Count connection failures as errors before retrying or letting the caller handle them
+            limiter.release(status_code=None, latency=None)
+            if (
+                isinstance(ex, retryable_errors)
+                and attempt < attempts - 1
+                and _is_method_retryable(retry_strategy, method)
+            ):
+                logger.warning(
+                    "%s request to %s failed due to: %s - retrying (%s/%s)...",
+                    method,
+                    url,
+                    ex,
+                    attempt + 1,
+                    attempts - 1,
+                    extra={"sampled": True},
+                )
+                time.sleep(retry_strategy.backoff_factor * (2**attempt))
+                continue
+            raise
+        retry_after = response.headers.get("Retry-After")
+        # "elapsed" runs until the headers arrive, so the size of the body doesn't count towards the latency
+        limiter.release(
+            status_code=response.status_code,
+            latency=response.elapsed.total_seconds(),
+            retry_after=retry_after,
+            endpoint=endpoint,
+        )
+
+        # Return anything we shouldn't retry
+        if not retry_strategy.is_retry(
+            method=method,
+            status_code=response.status_code,
+            has_retry_after=bool(retry_after),
+        ):
+            return response
+
+        # Out of attempts - as urllib3 does, raise so callers' "max retries exceeded" error handling kicks in
+        if attempt == attempts - 1:
+            if retry_strategy.raise_on_status:
+                response.close()
+                raise requests.exceptions.RetryError(
+                    f"Max retries exceeded with url: {url} (too many {response.status_code} error responses)"
+                )
+            return response
+
+        logger.warning(
+            "%s request to %s returned status code %s - retrying (%s/%s)...",
+            method,
+            url,
+            response.status_code,
+            attempt + 1,
+            attempts - 1,
+            extra={"sampled": True},
+        )
+        # 429s are paced by the limiter's Retry-After pause, 5xx's also back off exponentially
+        if response.status_code not in THROTTLE_STATUS_CODES:
+            time.sleep(retry_strategy.backoff_factor * (2**attempt))
+
+
+class _LimitedSession(requests.Session):
+    """
+    requests Session that routes every request (GET & POST alike) through an AdaptiveLimiter
+
+    Status-based retries are issued here rather than inside urllib3, so that the limiter sees the outcome of every attempt
+    & each retry has to queue for a slot again - the adapter is left to retry connection errors only
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, retry_strategy: Retry):
+        super().__init__()
+        self.limiter = limiter
+        self.retry_strategy = retry_strategy
+
+    def request(self, method, url, *args, **kwargs):
+        return _send_with_feedback(
+            limiter=self.limiter,
+            retry_strategy=self.retry_strategy,
+            send=lambda: super(_LimitedSession, self).request(
+                method, url, *args, **kwargs
+            ),
+            method=method,
+            url=url,
+        )
+
+
+class _Http2Response:
+    """
+    Wraps a httpx Response in the parts of the requests Response interface the rest of the application uses
+    """
+
+    def __init__(self, response, elapsed: timedelta):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.http_version = response.http_version
+        # As with requests, the time taken for the headers to arrive - httpx's own "elapsed" includes the body
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self._response.text
+
+    def json(self):
+        return self._response.json()
+
+    def iter_content(self, chunk_size: int = 1):
+        return self._response.iter_bytes(chunk_size=chunk_size)
+
+    def close(self):
+        self._response.close()
+
+
+class _Http2Session:
+    """
+    Session-like client that multiplexes concurrent requests as streams over a single HTTP/2 connection
+    Exposes the same get/post interface as our requests session, so the API functions below work with either transport
+
+    Requires the optional "httpx[http2]" dependency - pip install ".[http2]"
+    """
+
+    def __init__(
+        self,
+        limiter: AdaptiveLimiter,
+        retry_strategy: Retry,
+        prior_knowledge: bool = False,
+    ):
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError(
+                "The HTTP/2 transport requires the optional 'httpx[http2]' dependency - install it with: pip install '.[http2]'."
+            )
+
+        self.limiter = limiter
+        self.retry_strategy = retry_strategy
+        # A dropped connection fails every stream in flight on it - idempotent requests are re-sent, on a fresh connection
+        self.retryable_errors = (
+            httpx.RemoteProtocolError,
+            httpx.ReadError,
+            httpx.WriteError,
+        )
+        # Connect errors are retried by the transport, status codes through the limiter as with our requests session
+        # With prior knowledge we skip HTTP/1.1 entirely, which is how HTTP/2 is spoken over cleartext (h2c)
+        # As with requests, we don't time out - httpx would otherwise give up on a slow response after 5 seconds
+        self.client = httpx.Client(
+            timeout=None,
+            transport=httpx.HTTPTransport(
+                http1=not prior_knowledge,
+                http2=True,
+                retries=retry_strategy.total or 0,
+            ),
+        )
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: dict = None,
+        json=None,
+        stream: bool = False,
+    ):
+        def _send():
+            request = self.client.build_request(method, url, headers=headers, json=json)
+            start = time.monotonic()
+            # Always stream, so we can time the headers separately from the body
+            response = self.client.send(request, stream=True)
+            elapsed = timedelta(seconds=time.monotonic() - start)
+            if not stream:
+                try:
+                    response.read()
+                finally:
+                    response.close()
+            return _Http2Response(response, elapsed=elapsed)
+
+        return _send_with_feedback(
+            limiter=self.limiter,
+            retry_strategy=self.retry_strategy,
+            send=_send,
+            method=method,
+            url=url,
+            retryable_errors=self.retryable_errors,
+        )
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.client.close()
 
 
 # Mount our API endpoint onto our requests session - this allows us to pass the base session around functions
-def mount_endpoint(retry_strategy: Retry = _define_retry_strategy()):
+# "transport" picks the HTTP client underneath - "http1" (requests/urllib3), "http2" or "h2c" (httpx, optional dependency)
+def mount_endpoint(
+    retry_strategy: Retry = _define_retry_strategy(),
+    limiter: AdaptiveLimiter = None,
+    transport: str = "http1",
+):
+    if transport not in TRANSPORTS:
+        raise RuntimeError(
+            f"Unknown transport '{transport}' - expected one of: {', '.join(TRANSPORTS)}."
+        )
+    limiter = limiter if limiter is not None else AdaptiveLimiter()
+
+    # HTTP/2 multiplexes every request over one connection, so there is no connection pool to size
+    if transport != "http1":
+        return _Http2Session(
+            limiter=limiter,
+            retry_strategy=retry_strategy,
+            prior_knowledge=transport == "h2c",
+        )
+
     try:
-        # Initialise a session
-        req_session = requests.Session()
-        # Mount our retry strategy onto the session - we will use the https:// prefix for the most re-usability
+        # Initialise a session, every request made through it is gated by our adaptive limiter
+        req_session = _LimitedSession(limiter=limiter, retry_strategy=retry_strategy)
+        # Mount our retry strategy (connection errors only) onto the session - we will use the https:// prefix for the most re-usability
+        # urllib3 would otherwise retry a 429/503 carrying "Retry-After" itself, hiding the throttling from our limiter
+        # Size the connection pool to the limiter's ceiling so concurrent requests don't queue for a connection
         req_session.mount(
-            prefix="https://", adapter=HTTPAdapter(max_retries=retry_strategy)
+            prefix="https://",
+            adapter=HTTPAdapter(
+                max_retries=retry_strategy.new(
+                    status_forcelist=None, respect_retry_after_header=False
+                ),
+                pool_maxsize=limiter.max_limit,
+            ),
         )
 
         # Return the session for re-usability throughout code
         return req_session
     except Exception as ex:
         logger.warning(
-            f"Failure to successfully mount endpoint with retry strategy: {ex} - allowing application to continue..."
+            "Failure to successfully mount endpoint with retry strategy: %s - allowing application to continue...",
+            ex,
         )
 
 
@@ -37,24 +304,30 @@ def define_headers(api_key: str):
 
 # We can get the outages data from the API with a GET request
 def get_outages(
-    api_endpoint_url: str, headers: dict[str], requests_session: requests.Session
+    api_endpoint_url: str,
+    headers: dict[str],
+    requests_session: requests.Session,
+    stream: bool = False,
 ):
     # Using the requests library, we can issue get requests on API endpoints
     try:
         logger.info("Attempting to issue GET request to outages API endpoint...")
         # Ping the API endpoint using our session - returns a response Object
+        # With stream=True the body is left on the socket, to be read incrementally via response.iter_content()
         response = requests_session.get(
-            url=f"{api_endpoint_url}/outages", headers=headers
+            url=f"{api_endpoint_url}/outages", headers=headers, stream=stream
         )
         logger.info(
-            f"Outages GET request response: Status code = {response.status_code}."
+            "Outages GET request response: Status code = %s.", response.status_code
         )
 
         # Return the response as a JSON dictionary
         return response
     except Exception as ex:
         logger.error(
-            f"Max retries exceeded on GET request to {api_endpoint_url}/outages - due to {ex}... raising RuntimeError."
+            "Max retries exceeded on GET request to %s/outages - due to %s... raising RuntimeError.",
+            api_endpoint_url,
+            ex,
         )
         raise RuntimeError(
             f"Max retries exceeded on GET request to {api_endpoint_url}/outages - due to {ex}... cannot continue without outages data!."
@@ -63,27 +336,39 @@ def get_outages(
 
 # We can get the site-info data from the API with a separate GET request
 def get_site_info(
-    api_endpoint_url: str, headers: dict[str], requests_session: requests.Session
+    api_endpoint_url: str,
+    headers: dict[str],
+    requests_session: requests.Session,
+    site_id: str = "norwich-pear-tree",
 ):
     # Using the requests library, we can issue get requests on API endpoints
     try:
-        logger.info("Attempting to issue GET request to site-info API endpoint...")
+        logger.info(
+            "Attempting to issue GET request to site-info API endpoint for %s...",
+            site_id,
+            extra={"sampled": True},
+        )
         # Ping the API endpoint using our session - returns a response Object
         response = requests_session.get(
-            url=f"{api_endpoint_url}/site-info/norwich-pear-tree", headers=headers
+            url=f"{api_endpoint_url}/site-info/{site_id}", headers=headers
         )
         logger.info(
-            f"Site-info GET request response: Status code = {response.status_code}."
+            "Site-info GET request response for %s: Status code = %s.",
+            site_id,
+            response.status_code,
         )
 
         # Return the response as a JSON dictionary
         return response
     except Exception as ex:
         logger.error(
-            f"Max retries exceeded on GET request to {api_endpoint_url}/site-info/norwich-pear-tree - due to {ex}... raising RuntimeError."
+            "Max retries exceeded on GET request to %s/site-info/%s - due to %s... raising RuntimeError.",
+            api_endpoint_url,
+            site_id,
+            ex,
         )
         raise RuntimeError(
-            f"Max retries exceeded on GET request to {api_endpoint_url}/site-info/norwich-pear-tree - due to {ex}... cannot continue without site-info data!"
+            f"Max retries exceeded on GET request to {api_endpoint_url}/site-info/{site_id} - due to {ex}... cannot continue without site-info data!"
         )
 
 
@@ -93,15 +378,18 @@ def post_results(
     headers: dict[str],
     requests_session: requests.Session,
     data: list[dict],
+    site_id: str = "norwich-pear-tree",
 ):
     # Using the requests library, we can issue get requests on API endpoints
     try:
         logger.info(
-            "Attempting to POST results to site-info/<site-id> API endpoint..."
+            "Attempting to POST results to site-outages/%s API endpoint...",
+            site_id,
+            extra={"sampled": True},
         )
         # Ping the API endpoint using our session - returns a response Object
         response = requests_session.post(
-            url=f"{api_endpoint_url}/site-outages/norwich-pear-tree",
+            url=f"{api_endpoint_url}/site-outages/{site_id}",
             headers=headers,
             json=data,
         )
@@ -110,8 +398,11 @@ def post_results(
         return response
     except Exception as ex:
         logger.error(
-            f"Max retries exceeded on POST request to {api_endpoint_url}/site-outages/norwich-pear-tree - due to {ex}... raising RuntimeError."
+            "Max retries exceeded on POST request to %s/site-outages/%s - due to %s... raising RuntimeError.",
+            api_endpoint_url,
+            site_id,
+            ex,
         )
         raise RuntimeError(
-            f"Max retries exceeded on GET request to {api_endpoint_url}/site-outages/norwich-pear-tree - due to {ex}... cannot continue without site-info data!"
+            f"Max retries exceeded on GET request to {api_endpoint_url}/site-outages/{site_id} - due to {ex}... cannot continue without site-info data!"
         )
@@ -0,0 +1,199 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+# Instantiate logger at module level using the "__name__" variable
+logger = logging.getLogger(__name__)
+
+# Status codes that tell us the API is overloaded - we back off on these rather than treat them as hard failures
+THROTTLE_STATUS_CODES = frozenset([429])
+SERVER_ERROR_STATUS_CODES = frozenset([500, 501, 502, 503, 504])
+
+
+# Parse a "Retry-After" header - the spec allows either a number of seconds or a HTTP-date
+def _parse_retry_after(retry_after: str):
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        # A malformed header shouldn't break the request path - fall back to our own backoff
+        return None
+
+
+class TokenBucket:
+    """
+    Caps the rate of requests we send, regardless of how much concurrency the limiter allows
+    Tokens refill continuously at "rate" per second, up to "capacity" - each request takes one token
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+
+    # Take a token without blocking - returns how long the caller must wait before trying again (0.0 if taken)
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    # Block until a token is available
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait > 0.0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter driven by the feedback we get back from the API
+
+        - Additive increase: each healthy response grows the limit by 1/limit, i.e. roughly +1 per "round" of requests
+        - Multiplicative decrease: a 429, a 5xx rate above "error_threshold" or latency drifting above
+          "latency_tolerance" x the endpoint's baseline shrinks the limit by "backoff_ratio"
+          (latencies under "latency_floor" are ignored, sub-second jitter on a fast API isn't a sign of overload)
+        - Each endpoint has its own latency baseline, the best of its last "window_size" latencies - a large response
+          is only compared with the same endpoint, & a fast outlier is forgotten once it leaves the window
+        - A 429 "Retry-After" header pauses all new requests until the API tells us it is ready again
+
+    Decreases are applied at most once per "cooldown" window so that a burst of concurrent failures doesn't collapse the limit to 1
+    Requests also take a token from a TokenBucket so that we never exceed a hard request rate
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        rate: float = 20.0,
+        burst: float = None,
+        backoff_ratio: float = 0.5,
+        latency_tolerance: float = 2.0,
+        latency_floor: float = 0.25,
+        error_threshold: float = 0.1,
+        window_size: int = 20,
+        cooldown: float = 1.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.latency_floor = latency_floor
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.token_bucket = TokenBucket(rate=rate, capacity=burst)
+
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        # Rolling window of recent outcomes (True = 5xx) & of recent latencies per endpoint, used for our baselines
+        self._outcomes = deque(maxlen=window_size)
+        self._latencies = defaultdict(lambda: deque(maxlen=window_size))
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    # Block until we are below the concurrency limit, outside any Retry-After pause & have a rate token
+    def acquire(self):
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(timeout=pause)
+                elif self._in_flight >= self.limit:
+                    self._condition.wait()
+                else:
+                    self._in_flight += 1
+                    break
+
+        # Wait on the token bucket outside of the condition so other threads can still release slots
+        self.token_bucket.acquire()
+
+    # Release our slot & feed the outcome of the request back into the limit
+    # "endpoint" identifies which latency baseline the request is compared with, e.g. "GET /site-info/*"
+    def release(
+        self,
+        status_code: int = None,
+        latency: float = None,
+        retry_after: str = None,
+        endpoint: str = None,
+    ):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+
+            if status_code in THROTTLE_STATUS_CODES:
+                # The API has explicitly told us to slow down - honour "Retry-After" if given, otherwise use our cooldown
+                pause = _parse_retry_after(retry_after)
+                self._paused_until = max(
+                    self._paused_until,
+                    now + (pause if pause is not None else self.cooldown),
+                )
+                self._decrease(now=now, reason=f"throttled ({status_code})")
+            else:
+                # Connection errors (no status code) are counted alongside 5xx responses
+                self._outcomes.append(
+                    status_code is None or status_code in SERVER_ERROR_STATUS_CODES
+                )
+                baseline = None
+                if latency is not None and status_code is not None:
+                    latencies = self._latencies[endpoint]
+                    latencies.append(latency)
+                    baseline = min(latencies)
+
+                error_rate = sum(self._outcomes) / len(self._outcomes)
+                if self._outcomes[-1] and error_rate > self.error_threshold:
+                    self._decrease(now=now, reason=f"5xx rate {error_rate:.0%}")
+                elif (
+                    baseline
+                    and latency > self.latency_floor
+                    and latency > self.latency_tolerance * baseline
+                ):
+                    self._decrease(now=now, reason=f"latency {latency:.3f}s")
+                elif not self._outcomes[-1]:
+                    # Healthy response - additive increase
+                    self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+
+            self._condition.notify_all()
+
+    def _decrease(self, now: float, reason: str):
+        # Only back off once per cooldown window, concurrent failures are usually the same overload event
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+        logger.warning(
+            "API feedback indicates overload - %s, reducing concurrency limit to %s.",
+            reason,
+            self.limit,
+            extra={"sampled": True},
+        )
@@ -1,31 +1,205 @@
 import logging
 import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime
 import boto3
 from botocore.exceptions import HTTPClientError
-from yaml import safe_load
+from yaml import load
+from src.utils.api.api import TRANSPORTS
+
+# The C (libyaml) loader is many times faster than the pure-Python one, but is only available if PyYAML was built with it
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 
 # Instantiate logger at module level using the "__name__" variable
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+
+# Profile used when the KRAKEN_APP_PROFILE environment variable isn't set
+DEFAULT_PROFILE = "prod"
+
+# Parsed config files & validated settings - each entry remembers the version (mtime, size) of the file it came from
+_config_cache = {}
+_settings_cache = {}
+_cache_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class AppSettings:
+    """
+    Validated tuning knobs for a single profile - see the "defaults" section of config.yaml
+    """
+
+    profile: str
+    ssm: bool
+    site_ids: tuple
+    outages_cutoff: datetime
+    transport: str
+    concurrency_initial: int
+    concurrency_max: int
+    requests_per_second: float
+    stage_workers: int
+    stage_queue_size: int
+    transform_workers: int
+    out_of_core: bool
+    spill_memory_budget_bytes: int
+
+
+# Parse the config file once, re-parsing only when it changes on disk - returns the file version alongside its contents
+def _load_config(config_path: str):
+    config_stat = os.stat(config_path)
+    cache_key = os.path.abspath(config_path)
+    version = (config_stat.st_mtime_ns, config_stat.st_size)
+
+    with _cache_lock:
+        cached = _config_cache.get(cache_key)
+    if cached is not None and cached[0] == version:
+        return version, cached[1]
+
+    with open(config_path, "r") as config_file:
+        # We can load the contents of the yaml file into a dictionary object & parse through it
+        contents = load(config_file, Loader=_SafeLoader)
+
+    with _cache_lock:
+        _config_cache[cache_key] = (version, contents)
+    logger.info("Loaded configuration file '%s'.", config_path)
+    return version, contents
+
+
+# Profiles only list the values they change - overlay them onto the defaults, key by key
+def _deep_merge(base: dict, override: dict):
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _positive_int(value, name: str):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"'{name}' must be a positive integer, got {value!r}")
+    return value
+
+
+def _parse_settings(profile: str, contents: dict):
+    if profile not in contents:
+        raise ValueError(f"profile '{profile}' does not exist")
+
+    merged = _deep_merge(contents.get("defaults") or {}, contents.get(profile) or {})
+    tuning = merged["tuning"]
+
+    site_ids = tuning["site-ids"]
+    if not site_ids or not all(isinstance(site_id, str) for site_id in site_ids):
+        raise ValueError("'site-ids' must be a non-empty list of site-id strings")
+    requests_per_second = tuning["concurrency"]["requests-per-second"]
+    if isinstance(requests_per_second, bool) or not requests_per_second > 0:
+        raise ValueError(
+            f"'requests-per-second' must be positive, got {requests_per_second!r}"
+        )
+
+    settings = AppSettings(
+        profile=profile,
+        ssm=bool(merged.get("ssm", False)),
+        site_ids=tuple(site_ids),
+        outages_cutoff=datetime.strptime(
+            tuning["outages-cutoff"], "%Y-%m-%dT%H:%M:%S.%fZ"
+        ),
+        transport=str(tuning["transport"]),
+        concurrency_initial=_positive_int(
+            tuning["concurrency"]["initial"], "concurrency.initial"
+        ),
+        concurrency_max=_positive_int(tuning["concurrency"]["max"], "concurrency.max"),
+        requests_per_second=float(requests_per_second),
+        stage_workers=_positive_int(
+            tuning["pipeline"]["stage-workers"], "pipeline.stage-workers"
+        ),
+        stage_queue_size=_positive_int(
+            tuning["pipeline"]["queue-size"], "pipeline.queue-size"
+        ),
+        transform_workers=_positive_int(
+            tuning["transformation"]["workers"], "transformation.workers"
+        ),
+        out_of_core=bool(tuning["transformation"]["out-of-core"]),
+        spill_memory_budget_bytes=_positive_int(
+            tuning["transformation"]["spill-memory-budget-bytes"],
+            "transformation.spill-memory-budget-bytes",
+        ),
+    )
+    if settings.concurrency_initial > settings.concurrency_max:
+        raise ValueError(
+            "'concurrency.initial' cannot be greater than 'concurrency.max'"
+        )
+    if settings.transport not in TRANSPORTS:
+        raise ValueError(
+            f"'transport' must be one of: {', '.join(TRANSPORTS)}, got {settings.transport!r}"
+        )
+    # Out-of-core merges runs from disk in-process, so worker processes would be silently unused - reject rather than ignore them
+    if settings.out_of_core and settings.transform_workers > 1:
+        raise ValueError(
+            "'transformation.workers' must be 1 when 'transformation.out-of-core' is enabled"
+        )
+    return settings
+
+
+# Load the validated settings for a profile - cached until the config file changes on disk
+def load_settings(config_path: str, profile: str = None):
+    profile = profile or os.environ.get("KRAKEN_APP_PROFILE", DEFAULT_PROFILE)
+    try:
+        version, contents = _load_config(config_path=config_path)
+
+        cache_key = (os.path.abspath(config_path), profile)
+        with _cache_lock:
+            cached = _settings_cache.get(cache_key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        settings = _parse_settings(profile=profile, contents=contents)
+        with _cache_lock:
+            _settings_cache[cache_key] = (version, settings)
+        logger.info("Using configuration profile '%s'.", profile)
+        return settings
+
+    # Missing keys & badly typed values are the common mistakes when editing a profile - we should aim to catch these
+    except (KeyError, TypeError, ValueError, AttributeError) as parse_ex:
+        logger.error(
+            "Invalid configuration for profile '%s': %s - raising RunTime error to prevent further action being taken.",
+            profile,
+            parse_ex,
+        )
+        raise RuntimeError(
+            f"There has been an error parsing profile '{profile}' in the configuration file 'config.yaml' - please investigate the logs, refactor & re-try."
+        )
+    # We still need to catch any other unexpected errors, e.g. wrong file path provided at entry point
+    except Exception as ex:
+        logger.error(
+            "Unexpected error occurred: %s - raising RunTime error to prevent further action being taken.",
+            ex,
+        )
+        raise RuntimeError(
+            "There has been an error reading configuration file 'config.yaml' - please investigate the logs, refactor & re-try."
+        )
 
 
 # We don't want secrets & URLs stored in plain code - AWS Parameter Store is an easy & safe way to store secrets
-def _extract_config_values(config_path: str):
+def _extract_config_values(config_path: str, profile: str = DEFAULT_PROFILE):
     try:
-        with open(config_path, "r") as config_file:
-            # We can load the contents of the yaml file into a dictionary object & parse through it
-            contents = safe_load(config_file)
+        _, contents = _load_config(config_path=config_path)
 
-            # Parse the "contents" dictionary for our SSM API URL & Key secret names
-            ssm_api_url = contents.get("prod").get("secrets").get("aws").get("api-url")
-            ssm_api_key = contents.get("prod").get("secrets").get("aws").get("api-key")
+        # Parse the "contents" dictionary for our SSM API URL & Key secret names
+        ssm_api_url = contents.get(profile).get("secrets").get("aws").get("api-url")
+        ssm_api_key = contents.get(profile).get("secrets").get("aws").get("api-key")
 
         return ssm_api_url, ssm_api_key
 
     # AttributeError's are common when parsing dictionaries using .get() - we should aim to catch these
     except AttributeError as att_ex:
         logger.error(
-            f"AttributeError occurred when extracting secret name values: {att_ex} - raising RunTime error to prevent further action being taken."
+            "AttributeError occurred when extracting secret name values: %s - raising RunTime error to prevent further action being taken.",
+            att_ex,
         )
         raise RuntimeError(
             "There has been an error parsing the configuration file 'config.yaml' - please investigate the logs, refactor & re-try."
@@ -33,7 +207,8 @@ def _extract_config_values(config_path: str):
     # We still need to catch any other unexpected errors, e.g. wrong file path provided at entry point
     except Exception as ex:
         logger.error(
-            f"Unexpected error occurred: {ex} - raising RunTime error to prevent further action being taken."
+            "Unexpected error occurred: %s - raising RunTime error to prevent further action being taken.",
+            ex,
         )
         raise RuntimeError(
             "There has been an error reading configuration file 'config.yaml' - please investigate the logs, refactor & re-try."
@@ -68,7 +243,7 @@ def _extract_ssm_values(ssm_api_url: str, ssm_api_key: str):
     except Exception as config_ex:
         # Raise RuntimeError so that we can successfully retrieve variables from SSM before we try to ping the API
         logger.error(
-            f"Error exporting SSM parameters to global variables due to: {config_ex}."
+            "Error exporting SSM parameters to global variables due to: %s.", config_ex
         )
         raise RuntimeError(
             f"Error exporting SSM parameters to global variables due to: {config_ex}."
@@ -76,10 +251,12 @@ def _extract_ssm_values(ssm_api_url: str, ssm_api_key: str):
 
 
 # Orchestrating function - ensures our app.py script does not become convoluted with config init code
-def init_config(config_path: str, ssm_flag: bool):
+def init_config(config_path: str, ssm_flag: bool, profile: str = DEFAULT_PROFILE):
     if ssm_flag:
         # Call the _extract_config_values function
-        ssm_api_url, ssm_api_key = _extract_config_values(config_path=config_path)
+        ssm_api_url, ssm_api_key = _extract_config_values(
+            config_path=config_path, profile=profile
+        )
 
         # Call our SSM function
         API_URL, API_KEY = _extract_ssm_values(
@@ -100,7 +277,7 @@ def init_config(config_path: str, ssm_flag: bool):
             logger.error(
                 "Environment variables set incorrectly, please reset environment variables before continuing - raising Runtime error to prevent further action."
             )
-            logger.error(f"{env_var_ex}.")
+            logger.error("%s.", env_var_ex)
             raise RuntimeError(
                 "Environment variables set incorrectly, please reset environment variables before continuing."
             )
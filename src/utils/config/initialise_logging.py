@@ -0,0 +1,136 @@
+import atexit
+import logging
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from sys import stdout
+
+# Same layout as logging.basicConfig, e.g. "INFO:__main__:Loading application..."
+LOG_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+# The listener for this process - logging is only initialised once, however many times init_logging is called
+_listener = None
+_listener_lock = threading.Lock()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limits high-frequency log messages, e.g. per-request or per-chunk logs in batch runs
+
+    Only records logged with extra={"sampled": True} are sampled - anything else always passes
+    Each message template (per logger) gets "burst" records every "interval" seconds, further records are dropped
+    & counted, with the count appended to the next record that passes
+    """
+
+    def __init__(self, burst: int = 5, interval: float = 10.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord):
+        if not getattr(record, "sampled", False):
+            return True
+
+        # Key on the un-formatted template, so "GET ... for %s" is one message, whatever the site
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window_start, passed, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - window_start >= self.interval:
+                window_start, passed = now, 0
+            if passed >= self.burst:
+                self._windows[key] = (window_start, passed, suppressed + 1)
+                return False
+            self._windows[key] = (window_start, passed + 1, 0)
+
+        if suppressed and isinstance(record.args, tuple) and record.args:
+            record.msg = f"{record.msg} (%d similar messages suppressed)"
+            record.args = record.args + (suppressed,)
+        elif suppressed and not record.args:
+            # Without args the message isn't %-formatted, so the count can go straight into it
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread
+
+    The stock QueueHandler formats every record in the calling thread before queueing it - we only hand records to
+    a queue in this process, so the (potentially expensive) message formatting can happen off the hot path instead
+    """
+
+    def prepare(self, record: logging.LogRecord):
+        return record
+
+
+def init_logging(level: int = logging.INFO, stream=stdout):
+    """
+    Routes all logging through a queue, with the actual (blocking) log I/O done on a background QueueListener thread
+
+    Callers only pay for putting a record on an unbounded queue, so log I/O never stalls the request & transform paths
+    High-frequency messages can be sampled by logging them with extra={"sampled": True}
+    """
+    global _listener
+
+    with _listener_lock:
+        root_logger = logging.getLogger()
+        root_logger.setLevel(level)
+        if _listener is not None:
+            return _listener
+
+        stream_handler = logging.StreamHandler(stream)
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+        log_queue = SimpleQueue()
+        queue_handler = _LazyQueueHandler(log_queue)
+        queue_handler.addFilter(SamplingFilter())
+
+        # Replace any handlers already attached to the root logger, so records are only written once
+        for handler in root_logger.handlers[:]:
+            root_logger.removeHandler(handler)
+        root_logger.addHandler(queue_handler)
+
+        _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        # Flush anything still queued when the application exits
+        atexit.register(_listener.stop)
+
+        return _listener
+
+
+class _ForwardingHandler(logging.Handler):
+    """
+    Re-dispatches records received from worker processes to the matching logger in this process
+    """
+
+    def emit(self, record: logging.LogRecord):
+        record_logger = logging.getLogger(record.name)
+        if record_logger.isEnabledFor(record.levelno):
+            record_logger.handle(record)
+
+
+def init_worker_logging(log_queue, level: int = logging.INFO):
+    """
+    For use in a worker process - sends every record back to the parent process over "log_queue"
+
+    The stock QueueHandler formats each record before queueing it, so records are safe to pickle across processes
+    """
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(level)
+
+
+def forward_worker_logs(log_queue):
+    """
+    Starts a listener in the parent process that writes worker processes' records through our own logging setup
+    The caller stops the returned listener once the workers have finished
+    """
+    listener = QueueListener(log_queue, _ForwardingHandler())
+    listener.start()
+    return listener
@@ -0,0 +1,171 @@
+import logging
+import threading
+from queue import Queue
+from typing import Callable, Iterable
+
+# Instantiate logger at module level using the "__name__" variable
+logger = logging.getLogger(__name__)
+
+# Marker passed down the pipeline once a stage's input has been exhausted
+_END_OF_STREAM = object()
+# Marker for an item that failed in an earlier stage - later stages skip it rather than blocking the pipeline
+_FAILED = object()
+
+
+class Stage:
+    """
+    A single step of the pipeline - "func" is applied to each item by "workers" threads
+    """
+
+    def __init__(self, name: str, func: Callable, workers: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+class StageExecutor:
+    """
+    Runs items through a chain of stages, each stage connected to the next by a bounded queue
+
+    While one item is being posted, the next can be transformed & the one after that fetched, so wall-clock time
+    tends towards the slowest stage rather than the sum of all stages
+    Bounded queues give us backpressure - a fast stage blocks once "queue_size" items are waiting downstream,
+    which caps how many in-flight results we hold in memory at any one time
+
+    Results are returned in the same order as the input items, regardless of which worker finished first
+    If any item fails, the rest of the pipeline still drains & the first error is raised as a RuntimeError
+    A single item (e.g. a single-site run) is processed on the calling thread, without starting any workers
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 2):
+        if not stages:
+            raise ValueError("StageExecutor requires at least one stage.")
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self._errors = []
+        self._errors_lock = threading.Lock()
+
+    def _run_stage(
+        self,
+        stage: Stage,
+        in_queue: Queue,
+        out_queue: Queue,
+        remaining: list,
+        lock: threading.Lock,
+    ):
+        while True:
+            message = in_queue.get()
+            if message is _END_OF_STREAM:
+                # Put the marker back for our sibling workers, the last worker out forwards it downstream
+                in_queue.put(_END_OF_STREAM)
+                with lock:
+                    remaining[0] -= 1
+                    last_worker = remaining[0] == 0
+                if last_worker:
+                    out_queue.put(_END_OF_STREAM)
+                return
+
+            index, item = message
+            if item is not _FAILED:
+                try:
+                    item = stage.func(item)
+                except Exception as ex:
+                    logger.error(
+                        "Pipeline stage '%s' failed on item %s due to: %s.",
+                        stage.name,
+                        index,
+                        ex,
+                    )
+                    with self._errors_lock:
+                        self._errors.append((index, stage.name, ex))
+                    item = _FAILED
+            out_queue.put((index, item))
+
+    # A single item has nothing to overlap with, so we run it through each stage on the calling thread
+    def _run_inline(self, item):
+        for stage in self.stages:
+            try:
+                item = stage.func(item)
+            except Exception as ex:
+                logger.error(
+                    "Pipeline stage '%s' failed on item 0 due to: %s.", stage.name, ex
+                )
+                raise RuntimeError(
+                    f"Pipeline failed in stage '{stage.name}' on item 0 due to: {ex}."
+                )
+        return [item]
+
+    def run(self, items: Iterable):
+        self._errors = []
+
+        # When we know how many items there are, never start more workers for a stage than there are items
+        item_count = len(items) if hasattr(items, "__len__") else None
+        if item_count == 0:
+            return []
+        if item_count == 1:
+            return self._run_inline(next(iter(items)))
+
+        queues = [Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = []
+
+        # Start the workers for every stage before we feed anything in
+        for position, stage in enumerate(self.stages):
+            workers = min(stage.workers, item_count or stage.workers)
+            remaining, lock = [workers], threading.Lock()
+            for worker in range(workers):
+                thread = threading.Thread(
+                    target=self._run_stage,
+                    args=(
+                        stage,
+                        queues[position],
+                        queues[position + 1],
+                        remaining,
+                        lock,
+                    ),
+                    name=f"pipeline-{stage.name}-{worker}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        # Feed the source on its own thread - it blocks whenever the first queue is full
+        def _feed():
+            count = 0
+            try:
+                for index, item in enumerate(items):
+                    queues[0].put((index, item))
+                    count += 1
+            except Exception as ex:
+                logger.error(
+                    "Pipeline source failed after %s item(s) due to: %s.", count, ex
+                )
+                with self._errors_lock:
+                    self._errors.append((count, "source", ex))
+            finally:
+                # Always close the stream, otherwise the workers would wait forever
+                queues[0].put(_END_OF_STREAM)
+            logger.info("Pipeline source exhausted after %s item(s).", count)
+
+        feeder = threading.Thread(target=_feed, name="pipeline-source", daemon=True)
+        feeder.start()
+
+        # Drain the final queue on the calling thread, re-ordering results by their input index
+        results = {}
+        while True:
+            message = queues[-1].get()
+            if message is _END_OF_STREAM:
+                break
+            index, item = message
+            results[index] = item
+
+        feeder.join()
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            index, stage_name, ex = min(self._errors, key=lambda error: error[0])
+            raise RuntimeError(
+                f"Pipeline failed in stage '{stage_name}' on item {index} due to: {ex}."
+            )
+
+        return [results[index] for index in sorted(results)]
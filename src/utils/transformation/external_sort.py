@@ -0,0 +1,252 @@
+import codecs
+import heapq
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+from tempfile import TemporaryDirectory, mkstemp
+from typing import Iterable
+from src.utils.transformation.filter_outages import (
+    OUTAGES_CUTOFF,
+    _outage_began_after_cutoff,
+)
+
+# Instantiate logger at module level using the "__name__" variable
+logger = logging.getLogger(__name__)
+
+# Approximate number of bytes of outage records we hold in memory before spilling a sorted run to disk
+DEFAULT_MEMORY_BUDGET_BYTES = 64 * 1024 * 1024
+# Maximum number of runs we merge at once - any more & we merge in several passes, to stay within open file limits
+DEFAULT_FAN_IN = 64
+
+_json_decoder = json.JSONDecoder()
+
+
+# Outages are sorted on disk by (device ID, begin) - missing values sort first rather than breaking comparisons
+# Their position in the feed breaks ties, so the order on disk never depends on which run an outage landed in
+def _sort_key(outage: dict, index: int):
+    return (str(outage.get("id") or ""), str(outage.get("begin") or ""), index)
+
+
+def iter_json_array(chunks: Iterable):
+    """
+    Incrementally parses a top-level JSON array, yielding one element at a time
+    "chunks" can be bytes (e.g. response.iter_content()) or str - only one element needs to fit in memory at once
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer, position, exhausted, started = "", 0, False, False
+
+    def _read_more():
+        nonlocal buffer, position, exhausted
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer = buffer[position:] + decoder.decode(b"", final=True)
+        else:
+            text = decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            buffer = buffer[position:] + text
+        position = 0
+
+    while True:
+        # Skip whitespace & separators between elements
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            if exhausted:
+                raise ValueError("Unexpected end of JSON array.")
+            _read_more()
+            continue
+
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError("Expected a JSON array.")
+            started, position = True, position + 1
+            continue
+        if buffer[position] == "]":
+            return
+
+        try:
+            element, end = _json_decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if exhausted:
+                raise
+            # The element is split across chunks - read more & try again
+            _read_more()
+            continue
+        if end == len(buffer) and not exhausted:
+            # A number at the very end of the buffer may continue in the next chunk
+            _read_more()
+            continue
+
+        position = end
+        yield element
+
+
+# Fixed cost of each buffered (sort key, line) pair - the tuple itself & its pointer in the buffer list
+_BUFFERED_PAIR_BYTES = sys.getsizeof(((), "")) + 8
+
+
+# Approximate memory held by one buffered (sort key, line) pair - the pair, its slot in the buffer, the key & its strings
+def _buffered_size(sort_key: tuple, line: str):
+    return (
+        sys.getsizeof(line)
+        + sys.getsizeof(sort_key)
+        + sum(sys.getsizeof(value) for value in sort_key)
+        + _BUFFERED_PAIR_BYTES
+    )
+
+
+# "buffered" holds (sort key, line) pairs - each outage is serialised once, when it is buffered
+def _write_run(buffered: list[tuple], run_dir: str):
+    buffered.sort(key=lambda pair: pair[0])
+    file_descriptor, run_path = mkstemp(suffix=".jsonl", dir=run_dir)
+    with os.fdopen(file_descriptor, "w") as run_file:
+        run_file.writelines(line for _, line in buffered)
+    return run_path
+
+
+# Each line of a run is "[feed index, outage]" - yields (sort key, feed index, outage, line) so merges can key on the first
+def _read_run(run_path: str):
+    with open(run_path, "r") as run_file:
+        for line in run_file:
+            index, outage = json.loads(line)
+            yield _sort_key(outage, index), index, outage, line
+
+
+def spill_sorted_runs(
+    outages: Iterable[dict],
+    run_dir: str,
+    memory_budget_bytes: int = DEFAULT_MEMORY_BUDGET_BYTES,
+    fan_in: int = DEFAULT_FAN_IN,
+):
+    """
+    Streams outages into sorted runs on disk, spilling a run whenever the buffered records reach "memory_budget_bytes"
+    Records are buffered as their serialised lines (a fraction of the size of the parsed dicts) & measured as such
+    Each record keeps its position in the feed, so the final output can be returned in feed order
+    Runs are then merged down to at most "fan_in", so every later merge is a single pass that writes nothing to disk
+    Returns the paths of the runs, each sorted by (device ID, begin)
+    """
+    try:
+        run_paths, buffered, buffered_bytes = [], [], 0
+        for index, outage in enumerate(outages):
+            sort_key = _sort_key(outage, index)
+            line = json.dumps([index, outage]) + "\n"
+            buffered.append((sort_key, line))
+            buffered_bytes += _buffered_size(sort_key=sort_key, line=line)
+            if buffered_bytes >= memory_budget_bytes:
+                run_paths.append(_write_run(buffered=buffered, run_dir=run_dir))
+                buffered, buffered_bytes = [], 0
+
+        if buffered or not run_paths:
+            run_paths.append(_write_run(buffered=buffered, run_dir=run_dir))
+
+        spilled_runs = len(run_paths)
+        run_paths = _reduce_runs(run_paths=run_paths, run_dir=run_dir, fan_in=fan_in)
+
+        logger.info(
+            "Spilled outages data into %s sorted run(s) on disk, merged down to %s.",
+            spilled_runs,
+            len(run_paths),
+        )
+        return run_paths
+
+    except Exception as ex:
+        logger.error(
+            "Failure to spill outages data to disk due to: %s - raising RuntimeError to prevent further downstream errors.",
+            ex,
+        )
+        raise RuntimeError(f"Failure to spill outages data to disk due to: {ex}.")
+
+
+# Merge groups of runs into larger runs until there are no more than "fan_in" left - each group's inputs are removed once merged
+def _reduce_runs(run_paths: list[str], run_dir: str, fan_in: int):
+    while len(run_paths) > fan_in:
+        merged_paths = []
+        for start in range(0, len(run_paths), fan_in):
+            group = run_paths[start : start + fan_in]
+            file_descriptor, merged_path = mkstemp(suffix=".jsonl", dir=run_dir)
+            # Lines are copied across as they were written, rather than re-serialised
+            with os.fdopen(file_descriptor, "w") as merged_file:
+                merged_file.writelines(
+                    line
+                    for _, _, _, line in heapq.merge(
+                        *(_read_run(run_path) for run_path in group),
+                        key=lambda record: record[0],
+                    )
+                )
+            for run_path in group:
+                os.unlink(run_path)
+            merged_paths.append(merged_path)
+        run_paths = merged_paths
+
+    return run_paths
+
+
+def produce_final_output_from_runs(
+    run_paths: list[str],
+    site_info_data: dict,
+    cutoff: datetime = OUTAGES_CUTOFF,
+):
+    """
+    K-way merges sorted runs, applying the datetime filter, device filter & name enrichment as each outage streams past
+    Runs are only read, so the same runs (as returned by spill_sorted_runs) can produce the output for several sites
+    As with the in-memory functions, the output is in the same order as the outages feed
+    """
+    try:
+        # Map device ID -> name once, so filtering & enrichment are a single lookup per outage
+        device_names = {
+            device.get("id"): device.get("name")
+            for device in site_info_data.get("devices")
+        }
+
+        final_output = []
+        for _, index, outage, _ in heapq.merge(
+            *(_read_run(run_path) for run_path in run_paths),
+            key=lambda record: record[0],
+        ):
+            if (
+                _outage_began_after_cutoff(outage, cutoff)
+                and outage.get("id") in device_names
+            ):
+                outage["name"] = device_names[outage.get("id")]
+                final_output.append((index, outage))
+
+        # Only this site's outages are held in memory, so we can put them back into feed order here
+        final_output.sort(key=lambda item: item[0])
+
+        # Return our output
+        return [outage for _, outage in final_output]
+
+    except Exception as ex:
+        logger.error(
+            "Failure to generate output JSON from sorted runs due to: %s - raising RuntimeError to prevent further downstream errors.",
+            ex,
+        )
+        raise RuntimeError(
+            f"Failure to generate output JSON from sorted runs due to: {ex}."
+        )
+
+
+def produce_final_output_out_of_core(
+    outages: Iterable[dict],
+    site_info_data: dict,
+    memory_budget_bytes: int = DEFAULT_MEMORY_BUDGET_BYTES,
+    fan_in: int = DEFAULT_FAN_IN,
+    cutoff: datetime = OUTAGES_CUTOFF,
+):
+    """
+    Filters & enriches an outages feed that may not fit in memory - processing is bounded by disk rather than RAM
+    Only the final output (a single site's outages) is held in memory
+    """
+    with TemporaryDirectory(prefix="outages-") as run_dir:
+        run_paths = spill_sorted_runs(
+            outages=outages,
+            run_dir=run_dir,
+            memory_budget_bytes=memory_budget_bytes,
+            fan_in=fan_in,
+        )
+        return produce_final_output_from_runs(
+            run_paths=run_paths, site_info_data=site_info_data, cutoff=cutoff
+        )
@@ -3,24 +3,30 @@ from datetime import datetime
 
 # Instantiate logger at module level using the "__name__" variable
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
+# By default, outages that began before this datetime are filtered out
+OUTAGES_CUTOFF = datetime(2022, 1, 1, 0, 0, 0, 0)
 
-def filter_outages_by_datetime(outages: list[dict]):
+
+# Per-outage datetime check - shared with the streaming (out-of-core) transformation
+def _outage_began_after_cutoff(outage: dict, cutoff: datetime = OUTAGES_CUTOFF):
+    return datetime.strptime(outage.get("begin"), "%Y-%m-%dT%H:%M:%S.%fZ") >= cutoff
+
+
+def filter_outages_by_datetime(outages: list[dict], cutoff: datetime = OUTAGES_CUTOFF):
     try:
         # Apply a list comprehension filter on our outages list & return a filtered list
         filtered_outages_dt = [
-            outage
-            for outage in outages
-            if datetime.strptime(outage.get("begin"), "%Y-%m-%dT%H:%M:%S.%fZ")
-            >= datetime(2022, 1, 1, 0, 0, 0, 0)
+            outage for outage in outages if _outage_began_after_cutoff(outage, cutoff)
         ]
 
         # Return the filtered outages
         return filtered_outages_dt
     except Exception as ex:
         logger.error(
-            f"Failure to successfully filter the outages object for 'begin' datetimes <= 2022-01-01T00:00:00.000Z, due to: {ex}."
+            "Failure to successfully filter the outages object for 'begin' datetimes <= %s, due to: %s.",
+            cutoff.isoformat(),
+            ex,
         )
         # We can raise a RuntimeError as the final result must be correct for the application to successfully finish
         raise RuntimeError(
@@ -45,7 +51,8 @@ def filter_outages_by_site_info(filtered_outages_dt: dict, site_info_data: dict)
 
     except Exception as ex:
         logger.error(
-            f"Failure to successfully filter the outages object for ID's that exist in our site-info data, due to: {ex}."
+            "Failure to successfully filter the outages object for ID's that exist in our site-info data, due to: %s.",
+            ex,
         )
         # We can raise a RuntimeError as the final result must be correct for the application to successfully finish
         raise RuntimeError(
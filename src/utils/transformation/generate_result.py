@@ -2,7 +2,6 @@ import logging
 
 # Instantiate logger at module level using the "__name__" variable
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 
 def produce_final_output(filtered_outages: dict, site_info_data: dict):
@@ -31,7 +30,8 @@ def produce_final_output(filtered_outages: dict, site_info_data: dict):
 
     except Exception as ex:
         logger.error(
-            f"Failure to generate output JSON for POST request due to: {ex} - raising RuntimeError to prevent further downstream errors."
+            "Failure to generate output JSON for POST request due to: %s - raising RuntimeError to prevent further downstream errors.",
+            ex,
         )
         raise RuntimeError(
             f"Failure to generate output JSON for POST request due to: {ex}."
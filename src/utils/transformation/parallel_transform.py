@@ -0,0 +1,183 @@
+import heapq
+import logging
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from src.utils.config.initialise_logging import (
+    init_worker_logging,
+    forward_worker_logs,
+)
+from src.utils.transformation.filter_outages import (
+    OUTAGES_CUTOFF,
+    _outage_began_after_cutoff,
+)
+
+# Instantiate logger at module level using the "__name__" variable
+logger = logging.getLogger(__name__)
+
+# Below this many outages, the cost of pickling data to & from worker processes outweighs any speed up
+MIN_PARALLEL_OUTAGES = 10000
+
+# Device index & cutoff for the current worker process - set once per worker by "_init_worker" rather than pickled with every shard
+_worker_device_index = None
+_worker_cutoff = OUTAGES_CUTOFF
+
+
+def _init_worker(
+    device_index: dict, cutoff: datetime, log_queue, log_level: int = logging.INFO
+):
+    global _worker_device_index, _worker_cutoff
+    _worker_device_index = device_index
+    _worker_cutoff = cutoff
+    # Workers are spawned with no logging set up - send their records back to the parent to be written
+    init_worker_logging(log_queue=log_queue, level=log_level)
+
+
+# Map device ID -> ((site ID, device name), ...) across every site, so each outage needs a single lookup
+def _build_device_index(site_info_by_site: dict):
+    device_index = {}
+    for site_id, site_info_data in site_info_by_site.items():
+        # As with produce_final_output, the last device listed with an ID gives its name
+        device_names = {
+            device.get("id"): device.get("name")
+            for device in site_info_data.get("devices")
+        }
+        for device_id, name in device_names.items():
+            device_index.setdefault(device_id, []).append((site_id, name))
+    return {device_id: tuple(sites) for device_id, sites in device_index.items()}
+
+
+# Shard on a stable hash of the device ID - Python's built-in hash() of a str is randomised per process
+def _shard_for_device(device_id, shards: int):
+    return zlib.crc32(str(device_id).encode("utf-8")) % shards
+
+
+def _shard_outages(outages: list[dict], shards: int):
+    sharded = [[] for _ in range(shards)]
+    for index, outage in enumerate(outages):
+        # Keep the original position of each outage so that we can merge the shards back in a deterministic order
+        sharded[_shard_for_device(outage.get("id"), shards)].append((index, outage))
+    return sharded
+
+
+def _transform_shard(
+    shard: list[tuple], device_index: dict = None, cutoff: datetime = None
+):
+    # Inside a worker process we use the device index & cutoff broadcast by the pool initialiser
+    device_index = device_index if device_index is not None else _worker_device_index
+    cutoff = cutoff if cutoff is not None else _worker_cutoff
+
+    # Datetime filter, device filter & name enrichment in one pass - each site gets its own copy of an outage
+    # As with filter_outages_by_datetime, every outage is checked against the cutoff, so a malformed "begin" always raises
+    transformed = {}
+    for index, outage in shard:
+        if not _outage_began_after_cutoff(outage, cutoff):
+            continue
+        for site_id, name in device_index.get(outage.get("id"), ()):
+            transformed.setdefault(site_id, []).append(
+                (index, {**outage, "name": name})
+            )
+
+    # Each site's list is already in ascending index order, ready for a k-way merge
+    return transformed
+
+
+def produce_final_outputs_parallel(
+    outages: list[dict],
+    site_info_by_site: dict,
+    workers: int = None,
+    min_parallel_outages: int = MIN_PARALLEL_OUTAGES,
+    cutoff: datetime = OUTAGES_CUTOFF,
+):
+    """
+    Runs the datetime filter, device filter & name enrichment for every site across a single pool of worker processes
+
+    Outages are sharded once, by a hash of their device ID, & an index of every site's devices is sent to each worker once
+    Shards are merged back on their original position, so each site's result is identical to the three functions in sequence
+    Small feeds (or a single worker) are transformed in-process, pickling them across processes would only slow us down
+    Returns a dict of site ID -> final output
+    """
+    workers = workers or os.cpu_count() or 1
+
+    try:
+        device_index = _build_device_index(site_info_by_site)
+
+        if workers <= 1 or len(outages) < min_parallel_outages:
+            transformed_shards = [
+                _transform_shard(
+                    shard=list(enumerate(outages)),
+                    device_index=device_index,
+                    cutoff=cutoff,
+                )
+            ]
+        else:
+            shards = [
+                shard for shard in _shard_outages(outages, shards=workers) if shard
+            ]
+            logger.info(
+                "Transforming %s outages for %s site(s) across %s shards using %s worker processes...",
+                len(outages),
+                len(site_info_by_site),
+                len(shards),
+                workers,
+            )
+
+            # Spawn (rather than fork) workers - we are called from a threaded process & forking would copy its locks mid-use
+            mp_context = multiprocessing.get_context("spawn")
+            log_queue = mp_context.Queue()
+            log_forwarder = forward_worker_logs(log_queue=log_queue)
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=mp_context,
+                    initializer=_init_worker,
+                    initargs=(
+                        device_index,
+                        cutoff,
+                        log_queue,
+                        logging.getLogger().getEffectiveLevel(),
+                    ),
+                ) as executor:
+                    transformed_shards = list(executor.map(_transform_shard, shards))
+            finally:
+                log_forwarder.stop()
+
+        # Merge each site's shards back on the original position of each outage
+        return {
+            site_id: [
+                outage
+                for _, outage in heapq.merge(
+                    *(shard.get(site_id, []) for shard in transformed_shards),
+                    key=lambda item: item[0],
+                )
+            ]
+            for site_id in site_info_by_site
+        }
+
+    except Exception as ex:
+        logger.error(
+            "Failure to transform outages in parallel due to: %s - raising RuntimeError to prevent further downstream errors.",
+            ex,
+        )
+        raise RuntimeError(f"Failure to transform outages in parallel due to: {ex}.")
+
+
+def produce_final_output_parallel(
+    outages: list[dict],
+    site_info_data: dict,
+    workers: int = None,
+    min_parallel_outages: int = MIN_PARALLEL_OUTAGES,
+    cutoff: datetime = OUTAGES_CUTOFF,
+):
+    """
+    Single-site form of produce_final_outputs_parallel - prefer that when transforming several sites, so the pool is only started once
+    """
+    return produce_final_outputs_parallel(
+        outages=outages,
+        site_info_by_site={None: site_info_data},
+        workers=workers,
+        min_parallel_outages=min_parallel_outages,
+        cutoff=cutoff,
+    )[None]
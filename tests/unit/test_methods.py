@@ -1,18 +1,44 @@
 import os
 import json
+import logging
+import socket
+import threading
+import time
 import pytest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import Retry
 from src.utils.api.api import (
+    _endpoint_key,
+    _send_with_feedback,
     mount_endpoint,
     define_headers,
     get_outages,
     get_site_info,
     post_results,
 )
+from src.utils.api.limiter import AdaptiveLimiter, TokenBucket, _parse_retry_after
 from src.utils.transformation.filter_outages import (
     filter_outages_by_datetime,
     filter_outages_by_site_info,
 )
 from src.utils.transformation.generate_result import produce_final_output
+from src.utils.transformation.parallel_transform import (
+    produce_final_output_parallel,
+    produce_final_outputs_parallel,
+    _shard_outages,
+    _transform_shard,
+)
+from src.utils.transformation.external_sort import (
+    iter_json_array,
+    spill_sorted_runs,
+    produce_final_output_from_runs,
+    produce_final_output_out_of_core,
+)
+from src.utils.config.initialise_logging import SamplingFilter
+from src.utils.config.initialise_config import load_settings
+from src.utils.pipeline.stage_executor import Stage, StageExecutor
 
 """
 We need to setup our request session before we attempt to test our methods
@@ -133,6 +159,241 @@ def invalid_final_output():
         return json.loads(f.read())
 
 
+"""
+Session transports - an unknown transport should fail fast rather than returning a half-configured session
+"""
+
+
+def test_mount_endpoint_unknown_transport():
+    with pytest.raises(RuntimeError) as ex_info:
+        mount_endpoint(transport="http3")
+
+    assert "Unknown transport 'http3'" in ex_info.value.args[0]
+
+
+"""
+Session retries - run against a local stub server, so we can control the status codes returned & count the requests received
+"""
+
+
+@pytest.fixture
+def stub_api():
+    # Status codes to return, in order - the last one is repeated once the list runs out
+    stub = {"statuses": [200], "headers": {}, "body_delay": 0.0, "hits": 0}
+
+    class _StubHandler(BaseHTTPRequestHandler):
+        def _respond(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            status = stub["statuses"][min(stub["hits"], len(stub["statuses"]) - 1)]
+            stub["hits"] += 1
+            self.send_response(status)
+            for header, value in stub["headers"].items():
+                self.send_header(header, value)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            # Optionally hold the body back, as a large response body would take a while to arrive
+            self.wfile.flush()
+            time.sleep(stub["body_delay"])
+            self.wfile.write(b"{}")
+
+        do_GET = do_POST = _respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub["url"] = f"http://127.0.0.1:{server.server_port}"
+    yield stub
+    server.shutdown()
+
+
+@pytest.fixture
+def stub_session():
+    # No backoff, so our retries don't slow the tests down
+    session = mount_endpoint(
+        retry_strategy=Retry(total=2, status_forcelist=[503], backoff_factor=0)
+    )
+    # Our stub server is cleartext, so re-use the https:// adapter (& its retry strategy) for http:// too
+    session.mount("http://", session.get_adapter("https://"))
+    return session
+
+
+def test_get_retried_on_server_error(stub_api, stub_session):
+    stub_api["statuses"] = [503, 503, 200]
+
+    response = get_site_info(
+        api_endpoint_url=stub_api["url"], headers={}, requests_session=stub_session
+    )
+
+    # Both 503's should have been retried, with the final attempt succeeding
+    assert response.status_code == 200
+    assert stub_api["hits"] == 3
+
+
+def test_post_not_retried_on_server_error(stub_api, stub_session):
+    stub_api["statuses"] = [503]
+
+    response = post_results(
+        api_endpoint_url=stub_api["url"],
+        headers={},
+        requests_session=stub_session,
+        data=[],
+    )
+
+    # POST isn't idempotent, so it must only ever be sent once
+    assert response.status_code == 503
+    assert stub_api["hits"] == 1
+
+
+def test_throttling_retried_through_the_limiter(stub_api, stub_session):
+    stub_api["statuses"] = [429, 200]
+    stub_api["headers"] = {"Retry-After": "0"}
+    initial_limit = stub_session.limiter.limit
+
+    response = get_site_info(
+        api_endpoint_url=stub_api["url"], headers={}, requests_session=stub_session
+    )
+
+    # The 429 should have reached the limiter (& shrunk its limit) rather than being retried inside urllib3
+    assert response.status_code == 200
+    assert stub_api["hits"] == 2
+    assert stub_session.limiter.limit < initial_limit
+
+
+def test_latency_timed_until_headers_arrive(stub_api, stub_session, monkeypatch):
+    stub_api["body_delay"] = 0.5
+    releases = []
+    release = stub_session.limiter.release
+
+    def _record_release(**kwargs):
+        releases.append(kwargs)
+        release(**kwargs)
+
+    monkeypatch.setattr(stub_session.limiter, "release", _record_release)
+
+    get_outages(
+        api_endpoint_url=stub_api["url"], headers={}, requests_session=stub_session
+    )
+
+    # The slow body shouldn't count towards the latency the limiter sees
+    assert releases[0]["endpoint"] == "GET /outages"
+    assert releases[0]["latency"] < 0.5
+
+
+def test_get_raises_when_retries_exhausted(stub_api, stub_session):
+    stub_api["statuses"] = [503]
+
+    with pytest.raises(RuntimeError) as ex_info:
+        get_outages(
+            api_endpoint_url=stub_api["url"], headers={}, requests_session=stub_session
+        )
+
+    # The original attempt plus 2 retries, then the "cannot continue" error path
+    assert stub_api["hits"] == 3
+    assert "cannot continue without outages data" in ex_info.value.args[0]
+
+
+"""
+HTTP/2 transport - run against the benchmark's hypercorn stand-in, which speaks HTTP/2 over cleartext (h2c)
+"""
+
+
+@pytest.fixture
+def h2c_stand_in():
+    pytest.importorskip("httpx")
+    pytest.importorskip("hypercorn")
+    from benchmarks.bench_transport import _start_stand_in_server
+
+    # Ask the OS for a free port, then hand it to hypercorn
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    _, stop = _start_stand_in_server(port=port, server_latency=0.0)
+    yield f"http://127.0.0.1:{port}"
+    stop()
+
+
+def test_h2c_transport_speaks_http2(h2c_stand_in):
+    session = mount_endpoint(transport="h2c")
+
+    site_info_response = get_site_info(
+        api_endpoint_url=h2c_stand_in, headers={}, requests_session=session
+    )
+    post_response = post_results(
+        api_endpoint_url=h2c_stand_in,
+        headers={},
+        requests_session=session,
+        data=site_info_response.json()["devices"],
+    )
+    session.close()
+
+    assert site_info_response.http_version == "HTTP/2"
+    assert post_response.http_version == "HTTP/2"
+    assert post_response.status_code == 200
+    # As with our requests session, slow responses are waited on rather than timed out
+    assert session.client.timeout.read is None
+
+
+def test_h2c_transport_under_concurrent_requests(h2c_stand_in):
+    session = mount_endpoint(
+        transport="h2c",
+        limiter=AdaptiveLimiter(initial_limit=16, min_limit=16, max_limit=16, rate=1e6),
+    )
+
+    def _call(index: int):
+        if index % 2:
+            return get_site_info(
+                api_endpoint_url=h2c_stand_in, headers={}, requests_session=session
+            )
+        return post_results(
+            api_endpoint_url=h2c_stand_in,
+            headers={},
+            requests_session=session,
+            data=[],
+        )
+
+    # Many streams in flight at once over the one multiplexed connection
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(executor.map(_call, range(200)))
+    session.close()
+
+    assert all(response.status_code == 200 for response in responses)
+    assert all(response.http_version == "HTTP/2" for response in responses)
+
+
+@pytest.mark.parametrize("method, expected_attempts", [("GET", 2), ("POST", 1)])
+def test_dropped_connection_retried_for_idempotent_methods(method, expected_attempts):
+    httpx = pytest.importorskip("httpx")
+    attempts = []
+
+    # The first attempt loses its connection, as every stream does when a HTTP/2 connection is terminated
+    def _send():
+        attempts.append(method)
+        if len(attempts) == 1:
+            raise httpx.RemoteProtocolError("<ConnectionTerminated error_code:1>")
+        return requests.Response()
+
+    def send_with_feedback():
+        return _send_with_feedback(
+            limiter=AdaptiveLimiter(rate=1000.0),
+            retry_strategy=Retry(total=2, backoff_factor=0),
+            send=_send,
+            method=method,
+            url="http://stand-in/site-info",
+            retryable_errors=mount_endpoint(transport="h2c").retryable_errors,
+        )
+
+    # GET is re-sent on a fresh connection, POST isn't idempotent so the error reaches the caller
+    if expected_attempts == 1:
+        with pytest.raises(httpx.RemoteProtocolError):
+            send_with_feedback()
+    else:
+        send_with_feedback()
+    assert len(attempts) == expected_attempts
+
+
 """
 API function test - outages endpoint
 """
@@ -372,3 +633,476 @@ def test_post_valid_final_output(
 
     # We should 200 success response
     assert response.status_code == 200
+
+
+"""
+Adaptive limiter - concurrency should react to API feedback without any network calls
+"""
+
+
+@pytest.fixture
+def adaptive_limiter():
+    return AdaptiveLimiter(initial_limit=4, max_limit=8, rate=1000.0, cooldown=0.0)
+
+
+def test_adaptive_limiter_increases_on_healthy_responses(adaptive_limiter):
+    # Issue a "round" of healthy, equally fast requests
+    for _ in range(8):
+        adaptive_limiter.acquire()
+        adaptive_limiter.release(status_code=200, latency=0.1)
+
+    # Additive increase should have grown the limit, but never above the ceiling
+    assert 4 < adaptive_limiter.limit <= 8
+    assert adaptive_limiter.in_flight == 0
+
+
+def test_adaptive_limiter_backs_off_on_throttling(adaptive_limiter):
+    adaptive_limiter.acquire()
+    adaptive_limiter.release(status_code=429, latency=0.1, retry_after="0")
+
+    # A 429 should halve the limit
+    assert adaptive_limiter.limit == 2
+
+
+def test_adaptive_limiter_backs_off_on_server_errors(adaptive_limiter):
+    adaptive_limiter.acquire()
+    adaptive_limiter.release(status_code=503, latency=0.1)
+
+    # A single 5xx in an otherwise empty window is above our error threshold
+    assert adaptive_limiter.limit == 2
+
+
+def test_adaptive_limiter_latency_baseline_per_endpoint(adaptive_limiter):
+    for _ in range(4):
+        adaptive_limiter.acquire()
+        adaptive_limiter.release(
+            status_code=200, latency=0.3, endpoint="GET /site-info/*"
+        )
+    limit = adaptive_limiter.limit
+
+    # A large outages response is slow by nature - it shouldn't be judged against the small site-info calls
+    adaptive_limiter.acquire()
+    adaptive_limiter.release(status_code=200, latency=3.0, endpoint="GET /outages")
+
+    assert adaptive_limiter.limit >= limit
+
+
+def test_adaptive_limiter_latency_baseline_recovers_from_fast_outlier():
+    adaptive_limiter = AdaptiveLimiter(
+        initial_limit=4, max_limit=8, rate=1000.0, cooldown=0.0, window_size=2
+    )
+
+    # One unusually fast response, then the endpoint's normal latency
+    for latency in (0.3, 1.0):
+        adaptive_limiter.acquire()
+        adaptive_limiter.release(status_code=200, latency=latency)
+    assert adaptive_limiter.limit == 2
+
+    # Once the outlier leaves the window, normal latencies are healthy again
+    for _ in range(4):
+        adaptive_limiter.acquire()
+        adaptive_limiter.release(status_code=200, latency=1.0)
+    assert adaptive_limiter.limit > 2
+
+
+def test_endpoint_keys_share_a_baseline_across_sites():
+    assert _endpoint_key("get", "https://api/outages") == "GET /outages"
+    assert (
+        _endpoint_key("GET", "https://api/site-info/norwich-pear-tree")
+        == _endpoint_key("GET", "https://api/site-info/another-site")
+        == "GET /site-info/*"
+    )
+
+
+def test_retry_after_header_parsing():
+    # Both the delta-seconds & HTTP-date forms should be understood
+    assert _parse_retry_after("3") == 3.0
+    assert _parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert _parse_retry_after("not-a-date") is None
+
+
+def test_token_bucket_caps_request_rate():
+    token_bucket = TokenBucket(rate=1.0, capacity=2)
+
+    # We can burst up to the capacity of the bucket...
+    assert token_bucket.try_acquire() == 0.0
+    assert token_bucket.try_acquire() == 0.0
+    # ...but the next request has to wait for a refill
+    assert token_bucket.try_acquire() > 0.0
+
+
+"""
+Pipelined stage executor - results should come back in input order & failures should surface as RuntimeErrors
+"""
+
+
+def test_stage_executor_preserves_input_order():
+    pipeline = StageExecutor(
+        stages=[
+            Stage(name="double", func=lambda item: item * 2, workers=3),
+            Stage(name="stringify", func=str, workers=2),
+        ],
+        queue_size=1,
+    )
+
+    # Multiple workers per stage may finish out of order, but results must be returned in the order they were fed in
+    assert pipeline.run(range(20)) == [str(item * 2) for item in range(20)]
+
+
+def test_stage_executor_raises_on_stage_failure():
+    pipeline = StageExecutor(
+        stages=[Stage(name="invert", func=lambda item: 1 / item, workers=2)]
+    )
+
+    with pytest.raises(RuntimeError) as ex_info:
+        pipeline.run([1, 0, 2])
+
+    # The failing stage & item should be reported back to the caller
+    assert "stage 'invert' on item 1" in ex_info.value.args[0]
+
+
+def test_stage_executor_backpressure_bounds_in_flight_items():
+    queue_size, stages, workers = 2, 3, 3
+    counter = {"in_flight": 0, "max_in_flight": 0}
+    lock = threading.Lock()
+
+    # A generator has no length, so the pipeline can't know how many items are coming - it must rely on backpressure
+    def _source():
+        for item in range(50):
+            with lock:
+                counter["in_flight"] += 1
+                counter["max_in_flight"] = max(
+                    counter["max_in_flight"], counter["in_flight"]
+                )
+            yield item
+
+    def _slow_sink(item):
+        time.sleep(0.005)
+        with lock:
+            counter["in_flight"] -= 1
+        return item
+
+    pipeline = StageExecutor(
+        stages=[
+            Stage(name="first", func=lambda item: item),
+            Stage(name="second", func=lambda item: item),
+            Stage(name="slow", func=_slow_sink),
+        ],
+        queue_size=queue_size,
+    )
+
+    assert pipeline.run(_source()) == list(range(50))
+    # Each queue holds at most "queue_size" items & each worker one more - plus the one the source is waiting to queue
+    assert counter["max_in_flight"] <= queue_size * stages + workers + 1
+
+
+def test_stage_executor_runs_single_item_on_calling_thread():
+    pipeline = StageExecutor(
+        stages=[
+            Stage(
+                name="thread", func=lambda item: threading.current_thread(), workers=4
+            )
+        ]
+    )
+
+    # Nothing to overlap with a single item, so no worker threads should be started
+    assert pipeline.run(["only-site"]) == [threading.current_thread()]
+
+
+"""
+Parallel transformation - sharding across worker processes must give exactly the same output as the serial functions
+"""
+
+
+def test_parallel_output_matches_serial_output(
+    valid_outages, valid_site_info, valid_final_output
+):
+    # Force the process pool, even though our test feed is small
+    final_output = produce_final_output_parallel(
+        outages=valid_outages,
+        site_info_data=valid_site_info,
+        workers=2,
+        min_parallel_outages=0,
+    )
+
+    # Merging on the original positions means our output order is deterministic
+    assert final_output == valid_final_output
+
+
+def test_parallel_in_process_fallback_does_not_mutate_input(
+    valid_outages, valid_site_info, valid_final_output
+):
+    final_output = produce_final_output_parallel(
+        outages=valid_outages, site_info_data=valid_site_info, workers=1
+    )
+
+    assert final_output == valid_final_output
+    # The caller's outages should not have been enriched in place
+    assert not any("name" in outage for outage in valid_outages)
+
+
+def test_parallel_outputs_for_several_sites_from_one_pool(
+    valid_outages, valid_site_info, valid_final_output
+):
+    # A second site with none of our devices should get an empty output, without affecting the first
+    final_outputs = produce_final_outputs_parallel(
+        outages=valid_outages,
+        site_info_by_site={
+            "norwich-pear-tree": valid_site_info,
+            "empty-site": {"id": "empty-site", "devices": []},
+        },
+        workers=2,
+        min_parallel_outages=0,
+    )
+
+    assert final_outputs == {
+        "norwich-pear-tree": valid_final_output,
+        "empty-site": [],
+    }
+
+
+def test_parallel_worker_logs_reach_the_parent(
+    valid_outages, valid_site_info, monkeypatch, caplog
+):
+    # Log from inside each worker's shard transform - the records should be forwarded back to our process
+    monkeypatch.setattr(
+        "src.utils.transformation.parallel_transform._transform_shard",
+        _logging_transform_shard,
+    )
+
+    with caplog.at_level(logging.INFO):
+        produce_final_output_parallel(
+            outages=valid_outages,
+            site_info_data=valid_site_info,
+            workers=2,
+            min_parallel_outages=0,
+        )
+
+    assert any(
+        record.name == "tests.worker" and record.process != os.getpid()
+        for record in caplog.records
+    )
+
+
+# Module level, so that spawned workers can unpickle it - "_transform_shard" here is the original, un-patched function
+def _logging_transform_shard(shard, device_index=None, cutoff=None):
+    logging.getLogger("tests.worker").info("Transforming %s outages.", len(shard))
+    return _transform_shard(shard, device_index=device_index, cutoff=cutoff)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_parallel_invalid_outages(invalid_outages, valid_site_info, workers):
+    # Invalid outages should raise a RuntimeError in-process & across worker processes, just as they do serially
+    with pytest.raises(RuntimeError):
+        produce_final_output_parallel(
+            outages=invalid_outages,
+            site_info_data=valid_site_info,
+            workers=workers,
+            min_parallel_outages=0,
+        )
+
+
+def test_shard_outages_keeps_devices_together(valid_outages):
+    shards = _shard_outages(valid_outages, shards=4)
+
+    # Every outage lands in exactly one shard, & all outages for a device land in the same shard
+    assert sum(len(shard) for shard in shards) == len(valid_outages)
+    device_shards = {}
+    for position, shard in enumerate(shards):
+        for _, outage in shard:
+            assert device_shards.setdefault(outage["id"], position) == position
+
+
+"""
+Out-of-core transformation - streaming the outages feed through sorted runs on disk
+"""
+
+
+def test_iter_json_array_across_chunk_boundaries(valid_outages):
+    with open("./tests/events/outages/valid_outages.json", "rb") as f:
+        contents = f.read()
+
+    # Split the raw bytes into tiny chunks, so that elements (& numbers/strings within them) straddle chunk boundaries
+    chunks = (contents[start : start + 7] for start in range(0, len(contents), 7))
+
+    assert list(iter_json_array(chunks)) == valid_outages
+    # Top-level numbers can also be split across chunks
+    assert list(iter_json_array([b"[12", b"34, 5", b"6]"])) == [1234, 56]
+
+
+def test_out_of_core_output_matches_expected_output(
+    valid_outages, valid_site_info, valid_final_output
+):
+    # A tiny memory budget & fan-in forces many runs & a multi-pass merge
+    final_output = produce_final_output_out_of_core(
+        outages=iter(valid_outages),
+        site_info_data=valid_site_info,
+        memory_budget_bytes=1024,
+        fan_in=2,
+    )
+
+    # Output is in feed order, as with the in-memory functions
+    assert final_output == valid_final_output
+
+
+def test_out_of_core_output_keeps_feed_order(valid_outages, valid_site_info):
+    # Reversed, the feed is no longer in (device ID, begin) order - the output should follow the feed regardless
+    reversed_outages = list(reversed(valid_outages))
+    in_memory_output = produce_final_output(
+        filtered_outages=filter_outages_by_site_info(
+            filtered_outages_dt=filter_outages_by_datetime(
+                outages=[dict(outage) for outage in reversed_outages]
+            ),
+            site_info_data=valid_site_info,
+        ),
+        site_info_data=valid_site_info,
+    )
+
+    final_output = produce_final_output_out_of_core(
+        outages=iter(reversed_outages),
+        site_info_data=valid_site_info,
+        memory_budget_bytes=1024,
+        fan_in=2,
+    )
+
+    assert final_output == in_memory_output
+    assert final_output != sorted(
+        final_output, key=lambda outage: (outage["id"], outage["begin"])
+    )
+
+
+def test_spilled_runs_reduced_once_and_reusable(
+    tmp_path, valid_outages, valid_site_info, valid_final_output
+):
+    run_paths = spill_sorted_runs(
+        outages=iter(valid_outages),
+        run_dir=str(tmp_path),
+        memory_budget_bytes=1024,
+        fan_in=3,
+    )
+
+    # Runs are merged down to the fan-in, & the merged inputs are removed from disk
+    assert len(run_paths) <= 3
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(run_path) for run_path in run_paths
+    )
+
+    # Producing output for several sites reads the same runs, without writing anything new
+    for _ in range(3):
+        final_output = produce_final_output_from_runs(
+            run_paths=run_paths, site_info_data=valid_site_info
+        )
+        assert final_output == valid_final_output
+    assert len(os.listdir(tmp_path)) == len(run_paths)
+
+
+def test_out_of_core_invalid_outages(invalid_outages, valid_site_info):
+    # Invalid outages should raise a RuntimeError, just as they do when filtering in memory
+    with pytest.raises(RuntimeError):
+        produce_final_output_out_of_core(
+            outages=iter(invalid_outages), site_info_data=valid_site_info
+        )
+
+
+"""
+Log sampling - high-frequency messages should be rate limited, everything else should always pass
+"""
+
+
+def _log_record(msg: str, args: tuple, sampled: bool):
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, msg, args, None)
+    record.sampled = sampled
+    return record
+
+
+def test_sampling_filter_rate_limits_sampled_messages():
+    sampling_filter = SamplingFilter(burst=2, interval=60.0)
+
+    # Only the first "burst" records of the same template pass, whatever their args
+    passed = [
+        sampling_filter.filter(_log_record("GET for %s", (site,), sampled=True))
+        for site in ["a", "b", "c", "d"]
+    ]
+    assert passed == [True, True, False, False]
+
+    # Un-sampled records are never dropped
+    assert sampling_filter.filter(_log_record("GET for %s", ("e",), sampled=False))
+
+
+def test_sampling_filter_reports_suppressed_messages():
+    sampling_filter = SamplingFilter(burst=1, interval=0.0)
+
+    sampling_filter.filter(_log_record("GET for %s", ("a",), sampled=True))
+    # Force the next record into the same, exhausted window
+    sampling_filter.interval = 60.0
+    assert not sampling_filter.filter(_log_record("GET for %s", ("b",), sampled=True))
+
+    # Once a new window opens, the next record carries the suppressed count
+    sampling_filter.interval = 0.0
+    record = _log_record("GET for %s", ("c",), sampled=True)
+    assert sampling_filter.filter(record)
+    assert record.getMessage() == "GET for c (1 similar messages suppressed)"
+
+
+"""
+Configuration profiles - settings are validated, cached & re-loaded when the config file changes
+"""
+
+
+def test_load_settings_profiles_override_defaults():
+    prod_settings = load_settings(config_path="./config.yaml", profile="prod")
+    dev_settings = load_settings(config_path="./config.yaml", profile="dev")
+
+    # "dev" only overrides concurrency, everything else comes from the defaults
+    assert prod_settings.site_ids == ("norwich-pear-tree",)
+    assert dev_settings.concurrency_max < prod_settings.concurrency_max
+    assert dev_settings.outages_cutoff == prod_settings.outages_cutoff
+
+    # Settings are cached until the file changes
+    assert load_settings(config_path="./config.yaml", profile="prod") is prod_settings
+
+
+def test_load_settings_reloads_on_file_change(tmp_path):
+    with open("./config.yaml", "r") as f:
+        contents = f.read()
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(contents)
+
+    assert (
+        load_settings(config_path=str(config_path), profile="prod").transport == "http1"
+    )
+
+    # Change the file & bump its mtime, the next load should pick the change up
+    config_path.write_text(contents.replace("transport: http1", "transport: http2"))
+    os.utime(config_path, ns=(0, os.stat(config_path).st_mtime_ns + 1_000_000_000))
+
+    assert (
+        load_settings(config_path=str(config_path), profile="prod").transport == "http2"
+    )
+
+
+def test_load_settings_invalid_profile():
+    with pytest.raises(RuntimeError) as ex_info:
+        load_settings(config_path="./config.yaml", profile="does-not-exist")
+
+    assert "profile 'does-not-exist'" in ex_info.value.args[0]
+
+
+@pytest.mark.parametrize(
+    "original, replacement",
+    [
+        # Transports must be one that mount_endpoint supports
+        ("transport: http1", "transport: http3"),
+        # Worker processes can't be used out-of-core, so the combination is rejected rather than silently ignored
+        ("workers: 1\n      out-of-core: false", "workers: 4\n      out-of-core: true"),
+    ],
+)
+def test_load_settings_rejects_invalid_tuning(tmp_path, original, replacement):
+    with open("./config.yaml", "r") as f:
+        contents = f.read()
+    assert original in contents
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(contents.replace(original, replacement))
+
+    with pytest.raises(RuntimeError):
+        load_settings(config_path=str(config_path), profile="prod")